@@ -163,7 +163,15 @@ class FIPDataset(Dataset):
 
 
 def create_data_loaders(
-    root_dir, metadata_file, height_max, width_max, batch_size=32, num_workers=12
+    root_dir,
+    metadata_file,
+    height_max,
+    width_max,
+    batch_size=32,
+    num_workers=12,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=4,
 ):
 
     train_dataset = FIPDataset(
@@ -190,15 +198,23 @@ def create_data_loaders(
         height_max=height_max,
     )
 
+    # persistent workers and prefetching only apply when the data is loaded in worker processes
+    loader_kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "persistent_workers": persistent_workers and num_workers > 0,
+        "prefetch_factor": prefetch_factor if num_workers > 0 else None,
+    }
+
     train_loader = Dataloader(
-        train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs
     )
     val_loader = Dataloader(
-        val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     test_loader = Dataloader(
-        test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     return train_loader, val_loader, test_loader
@@ -213,6 +229,9 @@ class FIPDataModule(pl.LightningDataModule):
         height_max,
         batch_size=32,
         num_workers=12,
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
     ):
         super().__init__()
         self.root_dir = root_dir
@@ -221,6 +240,9 @@ class FIPDataModule(pl.LightningDataModule):
         self.height_max = height_max
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
 
     def prepare_data(self):
         pass
@@ -233,6 +255,9 @@ class FIPDataModule(pl.LightningDataModule):
             height_max=self.height_max,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
 
     def train_dataloader(self):
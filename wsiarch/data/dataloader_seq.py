@@ -66,7 +66,13 @@ class H5Dataset(Dataset):
 
 
 def create_data_loaders(
-    metadata_path, length_max=58182, batch_size=32, num_workers=12
+    metadata_path,
+    length_max=58182,
+    batch_size=32,
+    num_workers=12,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=4,
 ):
 
     train_dataset = H5Dataset(
@@ -87,15 +93,23 @@ def create_data_loaders(
         length_max=length_max,
     )
 
+    # persistent workers and prefetching only apply when the data is loaded in worker processes
+    loader_kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "persistent_workers": persistent_workers and num_workers > 0,
+        "prefetch_factor": prefetch_factor if num_workers > 0 else None,
+    }
+
     train_loader = Dataloader(
-        train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs
     )
     val_loader = Dataloader(
-        val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     test_loader = Dataloader(
-        test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     return train_loader, val_loader, test_loader
@@ -108,12 +122,18 @@ class H5DataModule(pl.LightningDataModule):
         length_max=58182,
         batch_size=32,
         num_workers=12,
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
     ):
         super().__init__()
         self.metadata_path = metadata_path
         self.length_max = length_max
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
 
     def prepare_data(self):
         pass
@@ -124,6 +144,9 @@ class H5DataModule(pl.LightningDataModule):
             length_max=self.length_max,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
 
     def train_dataloader(self):
@@ -4,8 +4,10 @@ import pandas as pd
 import h5py
 import pytorch_lightning as pl
 import numpy as np
+from collections import OrderedDict
 from PIL import Image
-from torch.utils.data import Dataset
+from tqdm import tqdm
+from torch.utils.data import Dataset, Sampler
 from torch.utils.data import DataLoader as Dataloader
 
 
@@ -23,6 +25,18 @@ def find_minimum_separation(coords):
     return min_distance
 
 
+def place_feature_image(
+    padded_feature_image, feature_image, top_left_corner_y, top_left_corner_x
+):
+    # Copy the feature image of shape (depth, height, width) into the padded feature image at (top_left_corner_y, top_left_corner_x)
+    height, width = feature_image.shape[-2], feature_image.shape[-1]
+    padded_feature_image[
+        :,
+        top_left_corner_y : top_left_corner_y + height,
+        top_left_corner_x : top_left_corner_x + width,
+    ].copy_(feature_image)
+
+
 def random_up_padding(feature_image, height_max, width_max):
     # The feature image should have shape (depth, height, width) where height <= height_max and width <= width_max
     depth, height, width = feature_image.shape
@@ -30,23 +44,75 @@ def random_up_padding(feature_image, height_max, width_max):
         width <= width_max and height <= height_max
     ), f"The width {width} and height {height} should be less than or equal to width_max {width_max} and height_max {height_max} respectively."
 
-    # Create a tensor of zeros with shape (depth, height_max, width_max)
-    padded_feature_image = np.zeros((depth, height_max, width_max))
+    # Create a float32 tensor of zeros with shape (depth, height_max, width_max), so that no cast is needed afterwards
+    padded_feature_image = torch.zeros(
+        (depth, height_max, width_max), dtype=torch.float32
+    )
 
     # Randomly find the top left corner to place the feature image
     top_left_corner_y = np.random.randint(0, height_max - height + 1)
     top_left_corner_x = np.random.randint(0, width_max - width + 1)
 
     # Place the feature image within the padded tensor
-    padded_feature_image[
-        :,
-        top_left_corner_y : top_left_corner_y + height,
-        top_left_corner_x : top_left_corner_x + width,
-    ] = feature_image
+    place_feature_image(
+        padded_feature_image,
+        torch.as_tensor(feature_image),
+        top_left_corner_y,
+        top_left_corner_x,
+    )
 
     return padded_feature_image
 
 
+def random_roll_padding(padded_feature_image, height, width):
+    # The feature image should already be zero padded at the bottom and right to shape (depth, height_max, width_max),
+    # with the actual feature image of shape (depth, height, width) in the top left corner
+    _, height_max, width_max = padded_feature_image.shape
+
+    # Randomly find the top left corner to place the feature image
+    top_left_corner_y = np.random.randint(0, height_max - height + 1)
+    top_left_corner_x = np.random.randint(0, width_max - width + 1)
+
+    # Rolling the padded feature image moves the feature image from the top left corner to (top_left_corner_y, top_left_corner_x), only zeros wrap around
+    return torch.roll(
+        padded_feature_image,
+        shifts=(top_left_corner_y, top_left_corner_x),
+        dims=(-2, -1),
+    )
+
+
+def dequantize_feature_images(feature_images, scales):
+    # Dequantize int8 feature images of shape (..., depth, height, width) with their per channel scales of shape (..., depth),
+    # the result has the dtype of the scales
+    return feature_images.to(scales.dtype) * scales[..., None, None]
+
+
+def pad_feature_images(
+    feature_images, top_left_corners, height_max, width_max, scales=None
+):
+    # Pad a list of feature images of shape (depth, height, width) into a single tensor of shape (batch_size, depth, height_max, width_max)
+    # on the device of the feature images, each feature image is placed at its (top_left_corner_y, top_left_corner_x).
+    # If the feature images are int8, their scales of shape (batch_size, depth) dequantize the padded batch in one go
+    padded_feature_images = feature_images[0].new_zeros(
+        (len(feature_images), feature_images[0].shape[0], height_max, width_max)
+    )
+
+    for i, (feature_image, (top_left_corner_y, top_left_corner_x)) in enumerate(
+        zip(feature_images, top_left_corners)
+    ):
+        place_feature_image(
+            padded_feature_images[i],
+            feature_image,
+            top_left_corner_y,
+            top_left_corner_x,
+        )
+
+    if scales is not None:
+        return dequantize_feature_images(padded_feature_images, scales)
+
+    return padded_feature_images
+
+
 def random_up_padding_FIP(
     feature_image,
     coords,
@@ -120,7 +186,19 @@ def random_up_padding_FIP(
 
 class FeatureImageDataset(Dataset):
     def __init__(
-        self, root_dir, metadata_file, split, width_max, height_max, transform=None
+        self,
+        root_dir,
+        metadata_file,
+        split,
+        width_max,
+        height_max,
+        transform=None,
+        use_memmap=False,
+        cache_rate=0.0,
+        max_open_files=128,
+        dtype=torch.float32,
+        packed_file=None,
+        pad_on_device=False,
     ):
         """
         Args:
@@ -128,6 +206,15 @@ class FeatureImageDataset(Dataset):
             metadata_file (string): Path to the metadata csv file.
             split (string): One of 'train' or 'val' to specify which split to load.
             transform (callable, optional): Optional transform to be applied on a sample.
+            use_memmap (bool): Read the feature images from the memory-mapped features.bin built by build_index instead of the individual h5 files.
+            cache_rate (float): Fraction of the samples whose feature images are cached in shared memory after they are first loaded.
+            max_open_files (int): Maximum number of h5 files each worker keeps open between samples.
+            dtype (torch.dtype): Dtype of the returned feature images, use torch.bfloat16 to halve the bytes sent to the GPU when training in bf16.
+            packed_file (string, optional): Name of the h5 file in root_dir written by pack_h5.pack_feature_images, read instead of the individual h5 files.
+                If it was packed with quantize=True, the int8 feature images are dequantized after padding, or on the device with pad_on_device.
+            pad_on_device (bool): Return the unpadded feature image with its random top left corner instead of the padded feature image,
+                the batches are then collated by collate_feature_images and padded on the device by pad_feature_images.
+                Quantized feature images are returned as int8 together with their scales, (feature_image, scales, top_left_corner, class_index).
         """
         self.root_dir = root_dir
         self.transform = transform
@@ -136,6 +223,9 @@ class FeatureImageDataset(Dataset):
         self.metadata = self.metadata[self.metadata["split"] == split]
         self.width_max = width_max
         self.height_max = height_max
+        self.use_memmap = use_memmap
+        self.dtype = dtype
+        self.pad_on_device = pad_on_device
 
         # Create a mapping from class names to indices
         self.class_to_index = {
@@ -143,41 +233,363 @@ class FeatureImageDataset(Dataset):
         }
         self.index_to_class = {idx: cls for cls, idx in self.class_to_index.items()}
 
+        # look up the labels and file names once here instead of through pandas for every sample
+        self.labels = (
+            self.metadata["class"].map(self.class_to_index).to_numpy(dtype=np.int64)
+        )
+        self.ids = self.metadata["idx"].astype(str).to_numpy()
+
+        self.packed_h5_path = (
+            os.path.join(root_dir, packed_file) if packed_file is not None else None
+        )
+        # per channel scales of the samples in this split in dataset order, only set if the packed feature images are int8
+        self.scales = None
+        if self.packed_h5_path is not None:
+            with h5py.File(self.packed_h5_path, "r") as packed_h5_file:
+                assert packed_h5_file["features"].shape[-2:] == (
+                    height_max,
+                    width_max,
+                ), f"The packed feature images have shape {packed_h5_file['features'].shape}, their height and width should be height_max {height_max} and width_max {width_max}."
+                packed_idxs = packed_h5_file["idx"][:]
+                packed_heights = packed_h5_file["heights"][:]
+                packed_widths = packed_h5_file["widths"][:]
+                packed_scales = (
+                    packed_h5_file["scales"][:] if "scales" in packed_h5_file else None
+                )
+
+            # keep the packed row, height and width of the samples in this split in dataset order
+            row_of_idx = {
+                str(sample_idx): row for row, sample_idx in enumerate(packed_idxs)
+            }
+            self.packed_rows = np.array(
+                [row_of_idx[sample_idx] for sample_idx in self.ids], dtype=np.int64
+            )
+            self.heights = packed_heights[self.packed_rows]
+            self.widths = packed_widths[self.packed_rows]
+            if packed_scales is not None:
+                # float32 holds the float16 scales exactly
+                self.scales = torch.from_numpy(
+                    packed_scales[self.packed_rows].astype(np.float32)
+                )
+
+        assert not (
+            pad_on_device and self.scales is not None and transform is not None
+        ), "The transform can not be applied to the int8 feature images before they are dequantized on the device."
+
+        if self.use_memmap:
+            self.features_path, offsets_path = self.build_index(
+                root_dir=root_dir, metadata_file=metadata_file
+            )
+            # each row of offsets.npy is (idx, byte offset, depth, height, width), keep the
+            # (byte offset, depth, height, width) of the samples in this split in dataset order
+            offsets = np.load(offsets_path)
+            row_of_idx = {
+                str(sample_idx): row for row, sample_idx in enumerate(offsets[:, 0])
+            }
+            self.offsets = offsets[
+                [row_of_idx[sample_idx] for sample_idx in self.ids], 1:
+            ]
+
+        # the memmap is opened lazily so that it is not pickled into the dataloader workers
+        self._features = None
+
+        # h5py file handles can not be shared across processes, so each worker keeps its own LRU of open files
+        self.max_open_files = max_open_files
+        self._h5_files = OrderedDict()
+        self._h5_pid = None
+
+        # The cache is allocated in shared memory before the dataloader workers are started, so that a feature image
+        # loaded by one worker is visible to all of them. Each slot holds a feature image in its top left corner and zeros
+        # elsewhere, so a cached feature image is already padded at the bottom and right. Quantized feature images are cached as int8.
+        self.cache_num = int(len(self.metadata) * cache_rate)
+        if self.cache_num > 0:
+            depth = self._get_depth()
+            self._cache = torch.zeros(
+                (self.cache_num, depth, height_max, width_max),
+                dtype=torch.int8 if self.scales is not None else torch.float32,
+            ).share_memory_()
+            self._cache_shapes = torch.zeros(
+                (self.cache_num, 2), dtype=torch.int64
+            ).share_memory_()
+            self._cache_filled = torch.zeros(
+                self.cache_num, dtype=torch.bool
+            ).share_memory_()
+
+    @classmethod
+    def build_index(cls, root_dir, metadata_file, overwrite=False):
+        """
+        Write the feature images of all the samples in the metadata (all splits) sequentially into root_dir/features.bin as float32,
+        together with root_dir/offsets.npy which has one int64 row (idx, byte offset, depth, height, width) per sample.
+        The index is cached on disk, so it is only built once unless overwrite is True.
+        Returns the paths to features.bin and offsets.npy.
+        """
+        features_path = os.path.join(root_dir, "features.bin")
+        offsets_path = os.path.join(root_dir, "offsets.npy")
+
+        if (
+            not overwrite
+            and os.path.exists(features_path)
+            and os.path.exists(offsets_path)
+        ):
+            return features_path, offsets_path
+
+        metadata = pd.read_csv(os.path.join(root_dir, metadata_file))
+
+        offsets = np.zeros((len(metadata), 5), dtype=np.int64)
+        offset = 0
+
+        with open(features_path, "wb") as features_file:
+            for i, sample_idx in enumerate(
+                tqdm(metadata["idx"], desc="Building feature image index...")
+            ):
+                h5_path = os.path.join(root_dir, str(sample_idx) + ".h5")
+
+                with h5py.File(h5_path, "r") as h5_file:
+                    feature_image = np.ascontiguousarray(
+                        h5_file["feature_image"][:], dtype=np.float32
+                    )
+
+                depth, height, width = feature_image.shape
+                offsets[i] = (sample_idx, offset, depth, height, width)
+
+                features_file.write(feature_image.tobytes())
+                offset += feature_image.nbytes
+
+        np.save(offsets_path, offsets)
+
+        return features_path, offsets_path
+
     def __len__(self):
         return len(self.metadata)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_features"] = None
+        state["_h5_files"] = OrderedDict()
+        state["_h5_pid"] = None
+        return state
+
+    def _get_h5_file(self, h5_path, rdcc_nbytes=16 * 1024 * 1024):
+        """Return an open handle to h5_path, reusing the handles opened earlier by the current process."""
+        # a forked worker inherits the handles of its parent, start over with its own cache
+        if self._h5_pid != os.getpid():
+            self._h5_files = OrderedDict()
+            self._h5_pid = os.getpid()
+
+        h5_file = self._h5_files.get(h5_path)
+
+        if h5_file is None:
+            h5_file = h5py.File(h5_path, "r", rdcc_nbytes=rdcc_nbytes)
+            self._h5_files[h5_path] = h5_file
+
+            if len(self._h5_files) > self.max_open_files:
+                _, least_recent_h5_file = self._h5_files.popitem(last=False)
+                least_recent_h5_file.close()
+        else:
+            self._h5_files.move_to_end(h5_path)
+
+        return h5_file
+
+    def _get_depth(self):
+        """Return the feature depth of the first sample without reading its feature image."""
+        if self.packed_h5_path is not None:
+            with h5py.File(self.packed_h5_path, "r") as packed_h5_file:
+                return packed_h5_file["features"].shape[1]
+
+        if self.use_memmap:
+            return int(self.offsets[0, 1])
+
+        h5_path = os.path.join(self.root_dir, self.ids[0] + ".h5")
+        with h5py.File(h5_path, "r") as h5_file:
+            return h5_file["feature_image"].shape[0]
+
+    def _load_feature_image(self, idx):
+        """
+        Return (feature_image, height, width) of the idx-th sample. The packed feature images are returned as stored,
+        padded at the bottom and right to (depth, height_max, width_max) and int8 if they are quantized,
+        the others have shape (depth, height, width).
+        """
+        if self.packed_h5_path is not None:
+            # all the samples live in one file, so this is a single chunk read and no file open
+            packed_h5_file = self._get_h5_file(
+                self.packed_h5_path, rdcc_nbytes=128 * 1024 * 1024
+            )
+            features = packed_h5_file["features"]
+
+            feature_image = np.empty(features.shape[1:], dtype=features.dtype)
+            features.read_direct(feature_image, source_sel=np.s_[self.packed_rows[idx]])
+
+            return feature_image, int(self.heights[idx]), int(self.widths[idx])
+
+        if self.use_memmap:
+            if self._features is None:
+                # copy-on-write, so that the views can be wrapped in tensors, features.bin is never written to
+                self._features = np.memmap(
+                    self.features_path, dtype=np.float32, mode="c"
+                )
+
+            offset, depth, height, width = self.offsets[idx].tolist()
+            start = offset // self._features.itemsize
+
+            # zero-copy view into the page cache
+            feature_image = self._features[
+                start : start + depth * height * width
+            ].reshape(depth, height, width)
+        else:
+            h5_path = os.path.join(self.root_dir, self.ids[idx] + ".h5")
+
+            h5_file = self._get_h5_file(h5_path)
+
+            # read the "feature_image" dataset directly into a float32 buffer
+            dataset = h5_file["feature_image"]
+            feature_image = np.empty(dataset.shape, dtype=np.float32)
+            dataset.read_direct(feature_image)
+
+        _, height, width = feature_image.shape
+
+        return feature_image, height, width
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        h5_path = os.path.join(
-            self.root_dir, str(self.metadata.iloc[idx]["idx"]) + ".h5"
-        )
+        if idx < self.cache_num and self._cache_filled[idx]:
+            height, width = self._cache_shapes[idx].tolist()
+            feature_image = self._cache[idx]
+            is_padded = True
+        else:
+            feature_image, height, width = self._load_feature_image(idx)
+            is_padded = self.packed_h5_path is not None
+
+            if idx < self.cache_num:
+                _, stored_height, stored_width = feature_image.shape
+                cache_slot = self._cache[idx, :, :stored_height, :stored_width]
+                cache_slot.numpy()[:] = feature_image
+                self._cache_shapes[idx, 0] = height
+                self._cache_shapes[idx, 1] = width
+                # only mark the slot as filled once the feature image has been written
+                self._cache_filled[idx] = True
+
+        # Get the class label
+        class_index = int(self.labels[idx])
+
+        if self.pad_on_device:
+            # only the feature image itself is sent to the main process, it is padded on the device after the transfer
+            feature_image = torch.as_tensor(feature_image)[:, :height, :width]
+
+            # Randomly find the top left corner to place the feature image
+            top_left_corner = (
+                np.random.randint(0, self.height_max - height + 1),
+                np.random.randint(0, self.width_max - width + 1),
+            )
 
-        h5_file = h5py.File(h5_path, "r")
+            if self.scales is not None:
+                # the int8 feature image is a quarter of the bytes of float32, it is dequantized on the device after padding
+                return (
+                    feature_image.contiguous(),
+                    self.scales[idx].to(self.dtype),
+                    top_left_corner,
+                    class_index,
+                )
 
-        # get the "feature_image" dataset
-        feature_image = h5_file["feature_image"][:]
+            feature_image = feature_image.to(self.dtype).contiguous()
+
+            if self.transform:
+                feature_image = self.transform(feature_image)
+
+            return feature_image, top_left_corner, class_index
 
         # randomly pad the feature image
-        feature_image = random_up_padding(
-            feature_image, width_max=self.width_max, height_max=self.height_max
-        )
+        if is_padded:
+            # already padded at the bottom and right, a single roll moves it into place
+            feature_image = random_roll_padding(
+                torch.as_tensor(feature_image), height=height, width=width
+            )
+        else:
+            feature_image = random_up_padding(
+                feature_image, width_max=self.width_max, height_max=self.height_max
+            )
+
+        if self.scales is not None:
+            feature_image = dequantize_feature_images(feature_image, self.scales[idx])
+
+        if self.dtype != torch.float32:
+            feature_image = feature_image.to(self.dtype)
 
         if self.transform:
             sample = self.transform(feature_image)
         else:
-            sample = torch.tensor(feature_image, dtype=torch.float32)
-
-        # Get the class label
-        class_label = self.metadata.iloc[idx]["class"]
-        class_index = self.class_to_index[class_label]
+            sample = feature_image
 
         return sample, class_index
 
 
+def collate_feature_images(batch):
+    """
+    Collate the samples of a FeatureImageDataset with pad_on_device=True. The feature images have different shapes,
+    so they are kept as a list, the top left corners are kept as a list of python ints so that they stay on the host.
+    The scales of quantized feature images are stacked into a (batch_size, depth) tensor between the feature images and the corners.
+    """
+    feature_images = [sample[0] for sample in batch]
+    top_left_corners = [
+        (int(top_left_corner_y), int(top_left_corner_x))
+        for (top_left_corner_y, top_left_corner_x) in (sample[-2] for sample in batch)
+    ]
+    class_indices = torch.tensor([sample[-1] for sample in batch])
+
+    if len(batch[0]) == 4:
+        scales = torch.stack([sample[1] for sample in batch])
+        return feature_images, scales, top_left_corners, class_indices
+
+    return feature_images, top_left_corners, class_indices
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    Quasi random order over the samples of a FeatureImageDataset with a packed_file. The samples are sorted by their row
+    in the packed h5 file and cut into blocks of block_size consecutive rows, every epoch the order of the blocks and the
+    order of the samples within each block are shuffled. The samples of a batch then come from one or two blocks,
+    so the reads of the packed h5 file stay close to sequential instead of jumping over the whole file.
+    """
+
+    def __init__(self, dataset, block_size=64):
+        assert (
+            dataset.packed_h5_path is not None
+        ), "BlockShuffleSampler needs a FeatureImageDataset with a packed_file."
+
+        # dataset indices in the order of their rows in the packed h5 file
+        self.sorted_indices = torch.from_numpy(np.argsort(dataset.packed_rows))
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.sorted_indices)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        blocks = torch.split(self.sorted_indices, self.block_size)
+        for block_idx in torch.randperm(len(blocks), generator=generator).tolist():
+            block = blocks[block_idx]
+            yield from block[torch.randperm(len(block), generator=generator)].tolist()
+
+
 def create_data_loaders(
-    root_dir, metadata_file, height_max, width_max, batch_size=32, num_workers=12
+    root_dir,
+    metadata_file,
+    height_max,
+    width_max,
+    batch_size=32,
+    num_workers=12,
+    use_memmap=False,
+    cache_rate=0.0,
+    dtype=torch.float32,
+    packed_file=None,
+    pad_on_device=False,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=4,
+    block_size=64,
 ):
 
     train_dataset = FeatureImageDataset(
@@ -186,6 +598,11 @@ def create_data_loaders(
         split="train",
         width_max=width_max,
         height_max=height_max,
+        use_memmap=use_memmap,
+        cache_rate=cache_rate,
+        dtype=dtype,
+        packed_file=packed_file,
+        pad_on_device=pad_on_device,
     )
 
     val_dataset = FeatureImageDataset(
@@ -194,6 +611,11 @@ def create_data_loaders(
         split="val",
         width_max=width_max,
         height_max=height_max,
+        use_memmap=use_memmap,
+        cache_rate=cache_rate,
+        dtype=dtype,
+        packed_file=packed_file,
+        pad_on_device=pad_on_device,
     )
 
     test_dataset = FeatureImageDataset(
@@ -202,17 +624,41 @@ def create_data_loaders(
         split="test",
         width_max=width_max,
         height_max=height_max,
+        use_memmap=use_memmap,
+        cache_rate=cache_rate,
+        dtype=dtype,
+        packed_file=packed_file,
+        pad_on_device=pad_on_device,
     )
 
-    train_loader = Dataloader(
-        train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
-    )
+    # persistent workers and prefetching only apply when the data is loaded in worker processes,
+    # pinned batches are copied to the GPU asynchronously by Lightning's batch transfer
+    loader_kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "persistent_workers": persistent_workers and num_workers > 0,
+        "prefetch_factor": prefetch_factor if num_workers > 0 else None,
+        "collate_fn": collate_feature_images if pad_on_device else None,
+    }
+
+    # the packed h5 file is read in shuffled blocks of consecutive rows instead of in a uniformly random order
+    if packed_file is not None:
+        train_loader = Dataloader(
+            train_dataset,
+            batch_size=batch_size,
+            sampler=BlockShuffleSampler(train_dataset, block_size=block_size),
+            **loader_kwargs,
+        )
+    else:
+        train_loader = Dataloader(
+            train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs
+        )
     val_loader = Dataloader(
-        val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     test_loader = Dataloader(
-        test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     return train_loader, val_loader, test_loader
@@ -227,6 +673,15 @@ class FeatureImageDataModule(pl.LightningDataModule):
         height_max,
         batch_size=32,
         num_workers=12,
+        use_memmap=False,
+        cache_rate=0.0,
+        dtype=torch.float32,
+        packed_file=None,
+        pad_on_device=False,
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
+        block_size=64,
     ):
         super().__init__()
         self.root_dir = root_dir
@@ -235,9 +690,21 @@ class FeatureImageDataModule(pl.LightningDataModule):
         self.height_max = height_max
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.use_memmap = use_memmap
+        self.cache_rate = cache_rate
+        self.dtype = dtype
+        self.packed_file = packed_file
+        self.pad_on_device = pad_on_device
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.block_size = block_size
 
     def prepare_data(self):
-        pass
+        if self.use_memmap:
+            FeatureImageDataset.build_index(
+                root_dir=self.root_dir, metadata_file=self.metadata_file
+            )
 
     def setup(self, stage=None):
         self.train_loader, self.val_loader, self.test_loader = create_data_loaders(
@@ -247,6 +714,15 @@ class FeatureImageDataModule(pl.LightningDataModule):
             height_max=self.height_max,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
+            use_memmap=self.use_memmap,
+            cache_rate=self.cache_rate,
+            dtype=self.dtype,
+            packed_file=self.packed_file,
+            pad_on_device=self.pad_on_device,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
+            block_size=self.block_size,
         )
 
     def train_dataloader(self):
@@ -6,6 +6,7 @@ import pytorch_lightning as pl
 import numpy as np
 import torch
 from PIL import Image
+from tqdm import tqdm
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader as Dataloader
 
@@ -37,6 +38,81 @@ cellnames = [
 ]
 
 
+def get_feature_paths(slide_result_path, feature_name="OG_features"):
+    # return the paths to the .pt feature files of all the cells in cellnames of a slide
+    all_feature_paths = []
+    for cellname in cellnames:
+        feature_dir = os.path.join(slide_result_path, "cells", cellname, feature_name)
+
+        # check if is dir
+        if os.path.isdir(feature_dir):
+            feature_files = os.listdir(feature_dir)
+            # check that the features end with .pt
+            feature_files = [f for f in feature_files if f.endswith(".pt")]
+            feature_paths = [os.path.join(feature_dir, f) for f in feature_files]
+
+            all_feature_paths.extend(feature_paths)
+
+    return all_feature_paths
+
+
+def migrate_feature_files(metadata_path, feature_name="OG_features", overwrite=False):
+    """
+    One-shot migration of the feature files of all the slides in the metadata (all splits) to bare float32 tensors
+    saved in the zip format of torch.save, which is what HemeCellMILDataset loads with weights_only=True.
+    Features saved as numpy arrays, lists or other dtypes, or in the legacy format, are converted and saved in place.
+    A marker file next to the metadata records that the migration is done, so it only runs once unless overwrite is True.
+    Returns the path to the marker file.
+    """
+    marker_path = os.path.splitext(metadata_path)[0] + f"_{feature_name}_migrated"
+
+    if not overwrite and os.path.exists(marker_path):
+        return marker_path
+
+    metadata = pd.read_csv(metadata_path)
+
+    for slide_result_path in tqdm(
+        metadata["slide_result_path"].unique(), desc="Migrating feature files..."
+    ):
+        for feature_path in get_feature_paths(slide_result_path, feature_name):
+            # the files are trusted here, they are the ones written by the feature extraction
+            feature = torch.load(feature_path, weights_only=False)
+            feature = torch.as_tensor(feature, dtype=torch.float32).contiguous()
+
+            # write to a temporary file first, so that an interrupted migration never leaves a truncated feature file
+            tmp_feature_path = feature_path + ".tmp"
+            torch.save(feature, tmp_feature_path)
+            os.replace(tmp_feature_path, feature_path)
+
+    # only written once all the feature files are migrated
+    with open(marker_path, "w"):
+        pass
+
+    return marker_path
+
+
+def warm_page_cache(worker_id):
+    """
+    worker_init_fn that asks the kernel to read the feature files of this worker's share of the slides into the page cache
+    in the background with posix_fadvise(WILLNEED), so that the samples drawn later find them in memory. This is done once
+    per worker (the workers are persistent) and is skipped where posix_fadvise is not available.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    worker_info = torch.utils.data.get_worker_info()
+    dataset = worker_info.dataset
+    slide_result_paths = dataset.metadata["slide_result_path"].unique()
+
+    for slide_result_path in slide_result_paths[worker_id :: worker_info.num_workers]:
+        for feature_path in get_feature_paths(slide_result_path, dataset.feature_name):
+            fd = os.open(feature_path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+
 class HemeCellMILDataset(Dataset):
     def __init__(
         self,
@@ -82,20 +158,7 @@ class HemeCellMILDataset(Dataset):
 
         slide_result_path = metadata_row["slide_result_path"].values[0]
 
-        all_feature_paths = []
-        for cellname in cellnames:
-            feature_dir = os.path.join(
-                slide_result_path, "cells", cellname, self.feature_name
-            )
-
-            # check if is dir
-            if os.path.isdir(feature_dir):
-                feature_files = os.listdir(feature_dir)
-                # check that the features end with .pt
-                feature_files = [f for f in feature_files if f.endswith(".pt")]
-                feature_paths = [os.path.join(feature_dir, f) for f in feature_files]
-
-                all_feature_paths.extend(feature_paths)
+        all_feature_paths = get_feature_paths(slide_result_path, self.feature_name)
 
         # randomly select self.length_max number of features, if there are less than self.length_max features, use bootstrapping
         if len(all_feature_paths) < self.length_max:
@@ -106,15 +169,15 @@ class HemeCellMILDataset(Dataset):
             feature_paths = np.random.choice(all_feature_paths, self.length_max)
 
         # each features has a shape of [d,], stack them to [self.length_max, d]
+        # the feature files are bare tensors (see migrate_feature_files, run by HemeCellMILModule.prepare_data), so they are loaded without unpickling arbitrary objects
         features = []
 
         for feature_path in feature_paths:
-            feature_path = os.path.join(feature_dir, feature_path)
-            feature = torch.load(feature_path)
+            feature = torch.load(feature_path, weights_only=True)
             features.append(feature)
 
-        # make sure all the features are torch tensors if they are not already
-        features = [torch.tensor(f, dtype=torch.float32) for f in features]
+        # make sure all the features are float32 torch tensors, this is free for the ones that already are
+        features = [torch.as_tensor(f, dtype=torch.float32) for f in features]
 
         x = torch.stack(features)
 
@@ -131,6 +194,9 @@ def create_data_loaders(
     feature_name="OG_features",
     batch_size=32,
     num_workers=12,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=4,
 ):
 
     train_dataset = HemeCellMILDataset(
@@ -154,15 +220,24 @@ def create_data_loaders(
         feature_name=feature_name,
     )
 
+    # persistent workers and prefetching only apply when the data is loaded in worker processes
+    loader_kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "persistent_workers": persistent_workers and num_workers > 0,
+        "prefetch_factor": prefetch_factor if num_workers > 0 else None,
+        "worker_init_fn": warm_page_cache,
+    }
+
     train_loader = Dataloader(
-        train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs
     )
     val_loader = Dataloader(
-        val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     test_loader = Dataloader(
-        test_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers
+        test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
     return train_loader, val_loader, test_loader
@@ -176,6 +251,9 @@ class HemeCellMILModule(pl.LightningDataModule):
         feature_name="OG_features",
         batch_size=32,
         num_workers=12,
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
     ):
         super().__init__()
         self.metadata_path = metadata_path
@@ -183,9 +261,15 @@ class HemeCellMILModule(pl.LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.feature_name = feature_name
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
 
     def prepare_data(self):
-        pass
+        # the dataset loads the feature files with weights_only=True, which needs them saved as bare tensors
+        migrate_feature_files(
+            metadata_path=self.metadata_path, feature_name=self.feature_name
+        )
 
     def setup(self, stage=None):
         self.train_loader, self.val_loader, self.test_loader = create_data_loaders(
@@ -194,6 +278,9 @@ class HemeCellMILModule(pl.LightningDataModule):
             batch_size=self.batch_size,
             feature_name=self.feature_name,
             num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
 
     def train_dataloader(self):
@@ -0,0 +1,112 @@
+import os
+import h5py
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+def quantize_feature_image(feature_image):
+    """
+    Quantize a float32 feature image of shape (depth, height, width) to int8 with one scale per channel,
+    scale[c] = max(|feature_image[c]|) / 127, so that feature_image[c] ~ int8_feature_image[c] * scale[c].
+    The scales are rounded to float16 before quantizing, so that the stored scales are exactly the ones used.
+    Returns (int8_feature_image, scales) with scales of shape (depth,) as float16.
+    """
+    scales = (np.abs(feature_image).max(axis=(1, 2)) / 127).astype(np.float16)
+    # all zero channels (and scales too small for float16) would divide by zero, any scale works for them
+    scales[scales == 0] = 1
+
+    int8_feature_image = (
+        np.round(feature_image / scales.astype(np.float32)[:, None, None])
+        .clip(-127, 127)
+        .astype(np.int8)
+    )
+
+    return int8_feature_image, scales
+
+
+def pack_feature_images(
+    root_dir,
+    metadata_file,
+    packed_file,
+    height_max=445,
+    width_max=230,
+    quantize=False,
+):
+    """
+    Pack the feature images of all the samples in the metadata (all splits) into a single h5 file root_dir/packed_file.
+    The feature image of the i-th sample is stored in features[i, :, :heights[i], :widths[i]], the rest of features[i] is zero.
+    Each sample is one chunk of shape (1, depth, height_max, width_max), so a sample is read with a single contiguous read.
+    The idx column of the metadata is stored alongside, so that the datasets can map their rows to the packed rows.
+    If quantize is True, the features are stored as int8 with per channel float16 scales in scales[i], see quantize_feature_image,
+    which is a quarter of the bytes to read, send to the GPU and pin. The datasets dequantize them on read or on the device.
+    """
+    metadata = pd.read_csv(os.path.join(root_dir, metadata_file))
+    sample_idxs = metadata["idx"].to_numpy(dtype=np.int64)
+    h5_paths = [
+        os.path.join(root_dir, str(sample_idx) + ".h5") for sample_idx in sample_idxs
+    ]
+
+    # first pass over the metadata only, to find the depth of the packed dataset
+    depth = 0
+    for h5_path in h5_paths:
+        with h5py.File(h5_path, "r") as h5_file:
+            depth = max(depth, h5_file["feature_image"].shape[0])
+
+    num_samples = len(h5_paths)
+
+    with h5py.File(os.path.join(root_dir, packed_file), "w") as packed_h5_file:
+        features = packed_h5_file.create_dataset(
+            "features",
+            shape=(num_samples, depth, height_max, width_max),
+            dtype=np.int8 if quantize else np.float32,
+            chunks=(1, depth, height_max, width_max),
+            compression="lzf",
+            fillvalue=0,
+        )
+        if quantize:
+            scales = packed_h5_file.create_dataset(
+                "scales", shape=(num_samples, depth), dtype=np.float16, fillvalue=1
+            )
+        heights = packed_h5_file.create_dataset(
+            "heights", shape=(num_samples,), dtype=np.int64
+        )
+        widths = packed_h5_file.create_dataset(
+            "widths", shape=(num_samples,), dtype=np.int64
+        )
+        packed_h5_file.create_dataset("idx", data=sample_idxs)
+
+        for i, h5_path in enumerate(tqdm(h5_paths, desc="Packing feature images...")):
+            with h5py.File(h5_path, "r") as h5_file:
+                feature_image = h5_file["feature_image"][:]
+
+            feature_depth, height, width = feature_image.shape
+            assert (
+                height <= height_max and width <= width_max
+            ), f"The height {height} and width {width} of {h5_path} should be less than or equal to height_max {height_max} and width_max {width_max} respectively."
+
+            if quantize:
+                feature_image, feature_scales = quantize_feature_image(
+                    np.asarray(feature_image, dtype=np.float32)
+                )
+                scales[i, :feature_depth] = feature_scales
+
+            # write the whole chunk at once, padded at the bottom and right with zeros
+            padded_feature_image = np.zeros(
+                (depth, height_max, width_max), dtype=features.dtype
+            )
+            padded_feature_image[:feature_depth, :height, :width] = feature_image
+
+            features[i] = padded_feature_image
+            heights[i] = height
+            widths[i] = width
+
+
+if __name__ == "__main__":
+    pack_feature_images(
+        root_dir="/media/hdd1/neo/LUAD-LUSC_FI",
+        metadata_file="metadata.csv",
+        packed_file="packed.h5",
+        height_max=445,
+        width_max=230,
+    )
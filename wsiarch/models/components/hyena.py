@@ -62,10 +62,13 @@ def fftconv2d(u, k, D):
     )  # now the shape of k_expanded is [batch, d_model, height, width]
 
     # now we invoke the convolution theorem, first we compute the FFT of the kernel and the input using torch.fft.rfftn
-    k_f = torch.fft.rfftn(k_expanded, s=(fft_height, fft_width), dim=(2, 3)) / (
-        fft_height * fft_width
+    # the FFTs are computed in float32, cuFFT does not support bfloat16 and only supports float16 for power of two sizes
+    k_f = torch.fft.rfftn(
+        k_expanded.to(dtype=torch.float32), s=(fft_height, fft_width), dim=(2, 3)
+    ) / (fft_height * fft_width)
+    u_f = torch.fft.rfftn(
+        u.to(dtype=torch.float32), s=(fft_height, fft_width), dim=(2, 3)
     )
-    u_f = torch.fft.rfftn(u, s=(fft_height, fft_width), dim=(2, 3))
 
     # assert that u_f and k_f have the same shape
     assert (
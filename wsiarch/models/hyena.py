@@ -7,11 +7,17 @@ from wsiarch.data.dataloaders import (
     FeatureImageDataset,
     create_data_loaders,
     FeatureImageDataModule,
+    pad_feature_images,
 )
-from torchmetrics import Accuracy, F1Score, AUROC
+from torchmetrics import Accuracy, F1Score, AUROC, MetricCollection
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from pytorch_lightning.loggers import TensorBoardLogger
 
+# allow TF32 tensor cores for the float32 matmuls that are left outside of autocast
+torch.set_float32_matmul_precision("high")
+# let cuDNN pick the fastest kernels for the fixed (height_max, width_max) channels last inputs
+torch.backends.cudnn.benchmark = True
+
 
 # Define the HyenaModel
 class HyenaModel(nn.Module):
@@ -25,6 +31,7 @@ class HyenaModel(nn.Module):
         filter_order=64,
         dropout=0.0,
         filter_dropout=0.0,
+        compile_head=True,
     ):
         super(HyenaModel, self).__init__()
         
@@ -49,62 +56,55 @@ class HyenaModel(nn.Module):
 
         self.maxpool = nn.AdaptiveMaxPool2d((1, 1))
 
-        self.linear1 = nn.Linear(d_model, 1024)
-        self.relu1 = nn.ReLU()
-
-        self.linear2 = nn.Linear(1024, 512)
-        self.relu2 = nn.ReLU()
-
-        self.linear3 = nn.Linear(512, 256)
-        self.relu3 = nn.ReLU()
-
-        self.linear4 = nn.Linear(256, 128)
-        self.relu4 = nn.ReLU()
+        self.head = nn.Sequential(
+            nn.Linear(d_model, 1024),
+            nn.ReLU(inplace=True),
+            nn.Linear(1024, 512),
+            nn.ReLU(inplace=True),
+            nn.Linear(512, 256),
+            nn.ReLU(inplace=True),
+            nn.Linear(256, 128),
+            nn.ReLU(inplace=True),
+            nn.Linear(128, num_classes),
+        )
 
-        self.linear5 = nn.Linear(128, num_classes)
+        if compile_head:
+            # compile in place so that the state dict keys stay the same
+            self.head.compile(mode="reduce-overhead", fullgraph=True)
 
         self.loss_fn = nn.CrossEntropyLoss()
 
-        self.train_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-        self.val_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-        self.test_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
+        # store the 4D weights (the short filter of the Hyena layer) channels last to match the inputs
+        self.to(memory_format=torch.channels_last)
 
-        self.train_f1 = F1Score(num_classes=num_classes, task="multiclass")
-        self.val_f1 = F1Score(num_classes=num_classes, task="multiclass")
-        self.test_f1 = F1Score(num_classes=num_classes, task="multiclass")
-
-        self.train_auroc = AUROC(num_classes=num_classes, task="multiclass")
-        self.val_auroc = AUROC(num_classes=num_classes, task="multiclass")
-        self.test_auroc = AUROC(num_classes=num_classes, task="multiclass")
+        # one collection per split, so that the metrics sharing state (accuracy and f1) are updated together
+        metrics = MetricCollection(
+            {
+                "accuracy": Accuracy(num_classes=num_classes, task="multiclass"),
+                "f1": F1Score(num_classes=num_classes, task="multiclass"),
+                "auroc": AUROC(num_classes=num_classes, task="multiclass"),
+            }
+        )
+        self.train_metrics = metrics.clone(prefix="train_")
+        self.val_metrics = metrics.clone(prefix="val_")
+        self.test_metrics = metrics.clone(prefix="test_")
 
     def forward(self, x):
-        height_x, width__x = x.shape[-2], x.shape[-1]
+        # channels last makes the (b, d, h, w) -> (b * h * w, d) projections of the Hyena layer free views
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.hyena_layer(x)
 
-        assert x.shape[-2] == self.height_max, f"{x.shape[-2]} != {self.height_max}"
-        assert x.shape[-1] == self.width_max, f"{x.shape[-1]} != {self.width_max}"
-        assert x.shape[1] == self.d_model, f"{x.shape[1]} != {self.d_model}"
-
         x = self.maxpool(x)
         x = torch.flatten(x, 1)
 
-        assert x.shape[1] == self.d_model and len(x.shape) == 2, f"Shape of x is {x.shape}, should be (batch_size, d_model)"
-
-        x = self.linear1(x)
-        x = self.relu1(x)
-        x = self.linear2(x)
-        x = self.relu2(x)
-        x = self.linear3(x)
-        x = self.relu3(x)
-        x = self.linear4(x)
-        x = self.relu4(x)
-        x = self.linear5(x)
+        x = self.head(x)
         return x
 
     def compute_metrics(self, outputs, targets):
-        accuracy = self.train_accuracy(outputs, targets)
-        f1 = self.train_f1(outputs, targets)
-        auroc = self.train_auroc(outputs, targets)
+        metrics = self.train_metrics(outputs, targets)
+        accuracy = metrics["train_accuracy"]
+        f1 = metrics["train_f1"]
+        auroc = metrics["train_auroc"]
         return accuracy, f1, auroc
 
     def training_step(self, batch):
@@ -141,6 +141,7 @@ class HyenaModelPL(pl.LightningModule):
         filter_order=64,
         dropout=0.0,
         filter_dropout=0.0,
+        compile_head=True,
     ):
         super().__init__()
         self.save_hyperparameters()
@@ -158,81 +159,80 @@ class HyenaModelPL(pl.LightningModule):
         # apply max pooling to the output of the Hyena layer
         self.maxpool = nn.AdaptiveMaxPool2d((1, 1))
 
-        # Fully connected layers
-        self.linear1 = nn.Linear(d_model, 1024)
-        self.relu1 = nn.ReLU()
-
-        self.linear2 = nn.Linear(1024, 512)
-        self.relu2 = nn.ReLU()
-
-        self.linear3 = nn.Linear(512, 256)
-        self.relu3 = nn.ReLU()
-
-        self.linear4 = nn.Linear(256, 128)
-        self.relu4 = nn.ReLU()
+        # Fully connected layers, fused by torch.compile into as few kernels as possible
+        self.head = nn.Sequential(
+            nn.Linear(d_model, 1024),
+            nn.ReLU(inplace=True),
+            nn.Linear(1024, 512),
+            nn.ReLU(inplace=True),
+            nn.Linear(512, 256),
+            nn.ReLU(inplace=True),
+            nn.Linear(256, 128),
+            nn.ReLU(inplace=True),
+            nn.Linear(128, num_classes),
+        )
 
-        self.linear5 = nn.Linear(128, num_classes)
+        if compile_head:
+            # compile in place so that the state dict keys stay the same
+            self.head.compile(mode="reduce-overhead", fullgraph=True)
 
         # Metrics
-        self.train_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-        self.val_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-        self.test_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-
-        self.train_f1 = F1Score(num_classes=num_classes, task="multiclass")
-        self.val_f1 = F1Score(num_classes=num_classes, task="multiclass")
-        self.test_f1 = F1Score(num_classes=num_classes, task="multiclass")
-
-        self.train_auroc = AUROC(num_classes=num_classes, task="multiclass")
-        self.val_auroc = AUROC(num_classes=num_classes, task="multiclass")
-        self.test_auroc = AUROC(num_classes=num_classes, task="multiclass")
+        # one collection per split, so that the metrics sharing state (accuracy and f1) are updated together
+        metrics = MetricCollection(
+            {
+                "accuracy": Accuracy(num_classes=num_classes, task="multiclass"),
+                "f1": F1Score(num_classes=num_classes, task="multiclass"),
+                "auroc": AUROC(num_classes=num_classes, task="multiclass"),
+            }
+        )
+        self.train_metrics = metrics.clone(prefix="train_")
+        self.val_metrics = metrics.clone(prefix="val_")
+        self.test_metrics = metrics.clone(prefix="test_")
 
         self.loss_fn = nn.CrossEntropyLoss()
 
+        # store the 4D weights (the short filter of the Hyena layer) channels last to match the inputs
+        self.to(memory_format=torch.channels_last)
+
     def forward(self, x):
+        # channels last makes the (b, d, h, w) -> (b * h * w, d) projections of the Hyena layer free views
+        x = x.contiguous(memory_format=torch.channels_last)
 
-        # what is the height and width of x?
-        height_x, width__x = x.shape[-2], x.shape[-1]
+        # x has shape (batch_size, d_model, height_max, width_max), it is not checked here to keep the forward free of host side shape checks
         x = self.hyena_layer(x)
 
-        # assert that x has shape (batch_size, d_model, height_max, width_max)
-        assert (
-            x.shape[-2] == self.hparams.height_max
-        ), f"{x.shape[-2]} != {self.hparams.height_max}"
-        assert (
-            x.shape[-1] == self.hparams.width_max
-        ), f"{x.shape[-1]} != {self.hparams.width_max}"
-        assert (
-            x.shape[1] == self.hparams.d_model
-        ), f"{x.shape[1]} != {self.hparams.d_model}"
-
         x = self.maxpool(x)  # now x has shape (batch_size, d_model, 1, 1)
 
         # before passing x through the fully connected layers, we need to flatten it to shape (batch_size, d_model)
         x = torch.flatten(x, 1)
 
-        assert (
-            x.shape[1] == self.hparams.d_model and len(x.shape) == 2
-        ), f"Shape of x is {x.shape}, should be (batch_size, d_model)"
-
-        x = self.linear1(x)
-        x = self.relu1(x)
-        x = self.linear2(x)
-        x = self.relu2(x)
-        x = self.linear3(x)
-        x = self.relu3(x)
-        x = self.linear4(x)
-        x = self.relu4(x)
-        x = self.linear5(x)
+        x = self.head(x)
         return x
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # batches of a FeatureImageDataModule with pad_on_device=True hold the unpadded feature images,
+        # they are only padded here, after the much smaller unpadded feature images are copied to the device,
+        # int8 feature images come with their scales and are dequantized here as well
+        if len(batch) in (3, 4):
+            feature_images, top_left_corners, y = batch[0], batch[-2], batch[-1]
+            x = pad_feature_images(
+                feature_images,
+                top_left_corners,
+                height_max=self.hparams.height_max,
+                width_max=self.hparams.width_max,
+                scales=batch[1] if len(batch) == 4 else None,
+            )
+            return x, y
+
+        return batch
+
     def training_step(self, batch, batch_idx):
         x, y = batch
+        # the forward and the loss run in bf16 autocast through the Trainer's precision="bf16-mixed", see train_model
         logits = self(x)
         loss = self.loss_fn(logits, y)
         self.log("train_loss", loss)
-        self.log("train_accuracy", self.train_accuracy(logits, y))
-        self.log("train_f1", self.train_f1(logits, y))
-        self.log("train_auroc", self.train_auroc(logits, y))
+        self.log_dict(self.train_metrics(logits, y))
         return loss
 
     def validation_step(self, batch, batch_idx):
@@ -240,18 +240,14 @@ class HyenaModelPL(pl.LightningModule):
         logits = self(x)
         loss = self.loss_fn(logits, y)
         self.log("val_loss", loss)
-        self.log("val_accuracy", self.val_accuracy(logits, y))
-        self.log("val_f1", self.val_f1(logits, y))
-        self.log("val_auroc", self.val_auroc(logits, y))
+        self.log_dict(self.val_metrics(logits, y))
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self(x)
         loss = self.loss_fn(logits, y)
         self.log("test_loss", loss)
-        self.log("test_accuracy", self.test_accuracy(logits, y))
-        self.log("test_f1", self.test_f1(logits, y))
-        self.log("test_auroc", self.test_auroc(logits, y))
+        self.log_dict(self.test_metrics(logits, y))
 
     def on_train_epoch_end(self):
         # Log the current learning rate
@@ -276,6 +272,8 @@ def train_model(data_dir, num_gpus=3, num_epochs=10):
         height_max=445,
         batch_size=1,
         num_workers=9,
+        dtype=torch.bfloat16,
+        pad_on_device=True,
     )
 
     model = HyenaModelPL(
@@ -299,6 +297,7 @@ def train_model(data_dir, num_gpus=3, num_epochs=10):
         logger=logger,
         devices=num_gpus,
         accelerator="gpu",  # 'ddp' for DistributedDataParallel
+        precision="bf16-mixed",
     )
     trainer.fit(model, data_module)
     trainer.test(model, data_module.test_dataloader())
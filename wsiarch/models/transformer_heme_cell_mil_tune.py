@@ -2,10 +2,10 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import math
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import ray
 import pytorch_lightning as pl
-from torchmetrics import Accuracy, F1Score, AUROC
+from torchmetrics import Accuracy, F1Score, AUROC, MetricCollection
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from pytorch_lightning.loggers import TensorBoardLogger
 from ray import tune
@@ -19,13 +19,23 @@ class Attn(nn.Module):
         self.head_dim = head_dim
         self.use_flash_attention = use_flash_attention
 
-    def forward(self, q, k, v):
-        if self.use_flash_attention:
-            attn_output = F.scaled_dot_product_attention(q, k, v, is_causal=False)
+        # prefer the fused kernels, which never materialize the attention matrix in HBM, and fall back to the math kernel
+        # for the inputs they do not support (e.g. flash needs fp16/bf16, efficient needs an aligned head_dim in fp32)
+        if use_flash_attention:
+            self.backends = [
+                SDPBackend.FLASH_ATTENTION,
+                SDPBackend.EFFICIENT_ATTENTION,
+                SDPBackend.MATH,
+            ]
         else:
-            attn_scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.head_dim)
-            attn_probs = F.softmax(attn_scores, dim=-1)
-            attn_output = torch.matmul(attn_probs, v)
+            self.backends = [SDPBackend.MATH]
+
+    def forward(self, q, k, v):
+        # the fused kernels need q, k and v to be contiguous in (batch, heads, length, head_dim) layout
+        with sdpa_kernel(self.backends):
+            attn_output = F.scaled_dot_product_attention(
+                q.contiguous(), k.contiguous(), v.contiguous(), is_causal=False
+            )
         return attn_output
 
 
@@ -41,9 +51,8 @@ class MultiHeadAttentionClassifier(nn.Module):
 
         assert d_model % num_heads == 0, "d_model must be divisible by num_heads"
 
-        self.q_proj = nn.Linear(d_model, d_model)
-        self.k_proj = nn.Linear(d_model, d_model)
-        self.v_proj = nn.Linear(d_model, d_model)
+        # a single projection for q, k and v, so that x is only read once
+        self.qkv_proj = nn.Linear(d_model, 3 * d_model)
         self.out_proj = nn.Linear(d_model, d_model)
 
         self.attn = Attn(head_dim=self.head_dim, use_flash_attention=use_flash_attention)
@@ -52,18 +61,17 @@ class MultiHeadAttentionClassifier(nn.Module):
         self.classifier = nn.Linear(d_model, num_classes)
 
     def forward(self, x):
-        batch_size, length, d_model = x.shape
-
-        assert d_model == self.d_model, f"Input feature depth == {d_model} must be equal to d_model == {self.d_model}"
-        assert type(self.length_max) == int, f"Input length must be an integer, got {type(self.length_max)}"
-        assert length == self.length_max, f"Input length == {length} must be equal to length_max == {self.length_max}"
+        batch_size = x.shape[0]
 
-        class_tokens = self.class_token.expand(batch_size, -1, -1)
-        x = torch.cat([class_tokens, x], dim=1)
+        # write the class token and x straight into one buffer, with the class token in slot 0
+        x_ext = x.new_empty(batch_size, x.shape[1] + 1, self.d_model)
+        x_ext[:, :1].copy_(self.class_token.expand(batch_size, 1, -1))
+        x_ext[:, 1:].copy_(x)
+        x = x_ext
 
-        q = self.q_proj(x).view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        k = self.k_proj(x).view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
-        v = self.v_proj(x).view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
+        # qkv has shape (3, batch_size, num_heads, length + 1, head_dim)
+        qkv = self.qkv_proj(x).view(batch_size, -1, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0)
 
         attn_output = self.attn(q, k, v)
         attn_output = attn_output.transpose(1, 2).contiguous().view(batch_size, -1, self.d_model)
@@ -90,17 +98,17 @@ class MultiHeadAttentionClassifierPL(pl.LightningModule):
         self.lr = lr
         self.num_epochs = num_epochs
 
-        self.train_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-        self.val_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-        self.test_accuracy = Accuracy(num_classes=num_classes, task="multiclass")
-
-        self.train_f1 = F1Score(num_classes=num_classes, task="multiclass")
-        self.val_f1 = F1Score(num_classes=num_classes, task="multiclass")
-        self.test_f1 = F1Score(num_classes=num_classes, task="multiclass")
-
-        self.train_auroc = AUROC(num_classes=num_classes, task="multiclass")
-        self.val_auroc = AUROC(num_classes=num_classes, task="multiclass")
-        self.test_auroc = AUROC(num_classes=num_classes, task="multiclass")
+        # one collection per split, so that the metrics sharing state (accuracy and f1) are updated together
+        metrics = MetricCollection(
+            {
+                "accuracy": Accuracy(num_classes=num_classes, task="multiclass"),
+                "f1": F1Score(num_classes=num_classes, task="multiclass"),
+                "auroc": AUROC(num_classes=num_classes, task="multiclass"),
+            }
+        )
+        self.train_metrics = metrics.clone(prefix="train_")
+        self.val_metrics = metrics.clone(prefix="val_")
+        self.test_metrics = metrics.clone(prefix="test_")
 
         self.loss_fn = nn.CrossEntropyLoss()
 
@@ -112,9 +120,7 @@ class MultiHeadAttentionClassifierPL(pl.LightningModule):
         logits = self(x)
         loss = self.loss_fn(logits, y)
         self.log("train_loss", loss)
-        self.log("train_accuracy", self.train_accuracy(logits, y))
-        self.log("train_f1", self.train_f1(logits, y))
-        self.log("train_auroc", self.train_auroc(logits, y))
+        self.log_dict(self.train_metrics(logits, y))
         return loss
 
     def validation_step(self, batch, batch_idx):
@@ -122,18 +128,14 @@ class MultiHeadAttentionClassifierPL(pl.LightningModule):
         logits = self(x)
         loss = self.loss_fn(logits, y)
         self.log("val_loss", loss)
-        self.log("val_accuracy", self.val_accuracy(logits, y))
-        self.log("val_f1", self.val_f1(logits, y))
-        self.log("val_auroc", self.val_auroc(logits, y))
+        self.log_dict(self.val_metrics(logits, y))
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self(x)
         loss = self.loss_fn(logits, y)
         self.log("test_loss", loss)
-        self.log("test_accuracy", self.test_accuracy(logits, y))
-        self.log("test_f1", self.test_f1(logits, y))
-        self.log("test_auroc", self.test_auroc(logits, y))
+        self.log_dict(self.test_metrics(logits, y))
 
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr)